@@ -1,11 +1,37 @@
 import pyvisa
 import time
+import ctypes
 import threading
-import csv
+import queue
 import os
-import matplotlib.pyplot as plt
+import sys
+import matplotlib
 import numpy as np
 
+# Agg unless --interactive: no GUI toolkit, no blocking show()
+interactive = "--interactive" in sys.argv
+if not interactive:
+    matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+try:
+    import msvcrt
+except ImportError:  # POSIX: fall back to polling stdin with select
+    msvcrt = None
+    import select
+
+try:
+    import pyfftw
+    pyfftw.interfaces.cache.enable()
+except ImportError:  # fall back to numpy.fft
+    pyfftw = None
+
+try:
+    from numba import njit
+except ImportError:  # run the helpers as plain Python
+    def njit(*args, **kwargs):
+        return lambda func: func
+
 # === CONFIGURATION ===
 save_folder = r"C:\Users\Brendan\Documents\lab\dataset"
 os.makedirs(save_folder, exist_ok=True)
@@ -23,93 +49,204 @@ duration = 14000         # total duration in seconds
 stop_flag = False
 marker_times = []
 set_times = []
-marker_lock = threading.Lock()
+stdin_open = True  # cleared on EOF so redirected/closed stdin isn't polled
+stdin_pending = ''  # POSIX: partial line read from stdin but not yet ended
 
-# === Input thread ===
-def monitor_input():
-    global stop_flag
+# === Sample bookkeeping ===
+@njit(cache=True)
+def record(buf_t, buf_r, buf_theta, idx, t, r, theta):
+    """Store one sample at position idx and return the next index."""
+    buf_t[idx] = t
+    buf_r[idx] = r
+    buf_theta[idx] = theta
+    return idx + 1
+
+# === Keyboard polling ===
+def poll_keys():
+    """Return the keys typed since the last call, without blocking."""
+    global stdin_open, stdin_pending
+    if msvcrt is not None:
+        keys = []
+        while msvcrt.kbhit():
+            keys.append(msvcrt.getwche().lower())
+        return keys
+    if not (stdin_open and select.select([sys.stdin], [], [], 0)[0]):
+        return []
+    # Read the fd directly: sys.stdin.readline() buffers ahead, which would
+    # hide a second line from select until yet another line arrives.
+    chunk = os.read(sys.stdin.fileno(), 1024)
+    if not chunk:  # EOF (nohup, cron, < /dev/null): keep logging, stop polling
+        stdin_open = False
+        return []
+    *lines, stdin_pending = (stdin_pending + chunk.decode(errors='ignore')).split('\n')
+    return [line.strip().lower()[:1] for line in lines if line.strip()]
+
+def wait_until(deadline):
+    """Sleep until deadline (perf_counter time), handling keys as they arrive."""
     while not stop_flag:
-        user_input = input().strip().lower()
-        current_t = time.time() - start_time
-
-        if user_input == 'm':
-            with marker_lock:
-                marker_times.append(current_t)
-            print(f"🔖 Marker (m) added at {current_t:.2f}s")
-        elif user_input == 'n':
-            with marker_lock:
-                set_times.append(current_t)
-            print(f"📍 Set (n) added at {current_t:.2f}s")
-        elif user_input == '':
-            stop_flag = True
-            print("🛑 Stopping early...")
-
-threading.Thread(target=monitor_input, daemon=True).start()
+        for key in poll_keys():
+            handle_marker(key, time.perf_counter() - start_time)
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            break
+        time.sleep(min(remaining, 0.01))
+
+def handle_marker(key, current_t):
+    global stop_flag
+    if key == 'm':
+        marker_times.append(current_t)
+        print(f"🔖 Marker (m) added at {current_t:.2f}s")
+    elif key == 'n':
+        set_times.append(current_t)
+        print(f"📍 Set (n) added at {current_t:.2f}s")
+    elif key == 'q':
+        stop_flag = True
+        print("🛑 Stopping early...")
 
 # === CSV Setup ===
-with open(csv_filename, mode='w', newline='') as file:
-    writer = csv.writer(file)
-    writer.writerow(["t (s)", "X (uV)", "Y (uV)", "R (uV)", "Theta (deg)", "Note"])
+file = open(csv_filename, mode='w', newline='', buffering=1 << 16)
+file.write("t (s),X (uV),Y (uV),R (uV),Theta (deg),Note\n")
+flush_every = 25  # rows between flush + fsync to disk (~5 s at 0.2 s sampling)
+print_every = 10  # samples between console status lines
+
+# === Background CSV writer ===
+# The measurement loop only enqueues samples; disk writes (and any stalls on a
+# synced folder) happen on this thread.
+sample_queue = queue.SimpleQueue()
+writer_error = None  # set by the worker if a write fails
+
+def csv_writer_worker():
+    global writer_error
+    rows = 0
+    while True:
+        sample = sample_queue.get()
+        if sample is None:  # sentinel: logging stopped
+            break
+        try:
+            t, x, y, r, theta = sample
+            file.write(f"{t:.5f},{x:.5f},{y:.5f},{r:.5f},{theta:.5f},\n")
+            rows += 1
+            if rows % flush_every == 0:
+                file.flush()
+                os.fsync(file.fileno())
+        except Exception as e:
+            writer_error = e
+            print("Write error:", e)
+            break
+
+writer_thread = threading.Thread(target=csv_writer_worker, daemon=True)
+writer_thread.start()
 
 # === Connect to SR865 ===
 rm = pyvisa.ResourceManager()
 sr865 = rm.open_resource("USB0::0xB506::0x2000::004198::INSTR")
+sr865.chunk_size = 102400
+sr865.read_termination = '\n'
+sr865.write_termination = '\n'
 print("Connected to:", sr865.query("*IDN?").strip())
-print("Type 'm' + Enter to mark a field switch, 'n' + Enter for a SET point, or just Enter to stop.\n")
+
+# Data channels 1-4 -> X, Y, R, Theta so SNAPD? returns all four in one query.
+# The SR865 only offers binary transfer for the capture buffer, so SNAPD? stays ASCII.
+# CDSP parameter codes 0-3 are X, Y, R, Theta, so channel n shows parameter n.
+for channel in range(4):
+    sr865.write(f"CDSP {channel}, {channel}")
+print("Press 'm' to mark a field switch, 'n' for a SET point, or 'q' to stop.\n")
 
 # === Data Storage ===
-t_values = []
-r_values = []
-theta_values = []
+n_max = int(duration / sampling_interval) + 16
+t_values = np.empty(n_max, dtype=np.float64)
+r_values = np.empty(n_max, dtype=np.float64)
+theta_values = np.empty(n_max, dtype=np.float64)
+idx = 0  # number of samples stored
+record(t_values, r_values, theta_values, 0, 0.0, 0.0, 0.0)  # JIT-compile before the clock starts
 
 # === Measurement Loop ===
-start_time = time.time()
+if sys.platform == 'win32':
+    ctypes.windll.winmm.timeBeginPeriod(1)  # 1 ms sleep resolution instead of 15.6 ms
 
-while not stop_flag:
-    current_time = time.time() - start_time
-    if current_time > duration:
-        break
+start_time = time.perf_counter()  # monotonic, high resolution; immune to clock steps
+k = 0  # sample index, used for drift-free deadlines
 
-    try:
-        x = float(sr865.query("OUTP? 0")) * 1e6
-        y = float(sr865.query("OUTP? 1")) * 1e6
-        r = float(sr865.query("OUTP? 2")) * 1e6
-        theta = float(sr865.query("OUTP? 3"))
+try:
+    while not stop_flag:
+        current_time = time.perf_counter() - start_time
+        if current_time > duration:
+            break
 
-        t_values.append(current_time)
-        r_values.append(r)
-        theta_values.append(theta)
+        try:
+            x, y, r, theta = sr865.query_ascii_values("SNAPD?", container=list)
+            x *= 1e6
+            y *= 1e6
+            r *= 1e6
 
-        with open(csv_filename, mode='a', newline='') as file:
-            writer = csv.writer(file)
-            writer.writerow([f"{current_time:.5f}", f"{x:.5f}", f"{y:.5f}", f"{r:.5f}", f"{theta:.5f}", ""])
+            idx = record(t_values, r_values, theta_values, idx, current_time, r, theta)
 
-        print(f"t = {current_time:6.2f}s | X = {x:.2f} uV, Y = {y:.2f} uV → R = {r:.2f} uV, θ = {theta:.2f}°")
+            if writer_error is None:
+                sample_queue.put((current_time, x, y, r, theta))
 
-    except Exception as e:
-        print("Read error:", e)
+            if (idx - 1) % print_every == 0:
+                print(f"t = {current_time:6.2f}s | X = {x:.2f} uV, Y = {y:.2f} uV → R = {r:.2f} uV, θ = {theta:.2f}°")
 
-    time.sleep(sampling_interval)
+        except Exception as e:
+            print("Read error:", e)
 
-# === Handle Markers ===
-with open(csv_filename, mode='a', newline='') as file:
-    writer = csv.writer(file)
-    for mark_time in marker_times:
-        writer.writerow([f"{mark_time:.5f}", "", "", "", "", "MARK"])
-    for set_time in set_times:
-        writer.writerow([f"{set_time:.5f}", "", "", "", "", "SET"])
+        # Wait (polling keys) until the next absolute deadline so query latency doesn't accumulate.
+        # If a slow read made us miss deadlines, skip them rather than bursting.
+        k += 1
+        now = time.perf_counter()
+        if start_time + k * sampling_interval <= now:
+            k = int((now - start_time) / sampling_interval) + 1
+        wait_until(start_time + k * sampling_interval)
+finally:
+    if sys.platform == 'win32':
+        ctypes.windll.winmm.timeEndPeriod(1)
+    sample_queue.put(None)
+    writer_thread.join()
+
+    # === Handle Markers ===
+    # After a write failure (full disk, lost network drive) the file is left
+    # as is, so the error doesn't escape and skip the plots below.
+    if writer_error is None:
+        mark_suffix = ",,,,,MARK\n"
+        set_suffix = ",,,,,SET\n"
+        try:
+            for mark_time in marker_times:
+                file.write(f"{mark_time:.5f}{mark_suffix}")
+            for set_time in set_times:
+                file.write(f"{set_time:.5f}{set_suffix}")
+        except OSError as e:
+            writer_error = e
+    try:
+        file.close()
+    except OSError as e:
+        if writer_error is None:
+            writer_error = e
+
+t_values = t_values[:idx]
+r_values = r_values[:idx]
+theta_values = theta_values[:idx]
 
 # === Cleanup ===
 sr865.close()
-print("\n✅ Logging stopped. Data saved to CSV.")
+if writer_error is None:
+    print("\n✅ Logging stopped. Data saved to CSV.")
+else:
+    print(f"\n❌ Logging stopped, but writing the CSV failed: {writer_error}")
+    print("   X and Y after the failure were not saved; R and Theta are kept for the plots and FFT.")
 
 # === Plot R vs t ===
+def draw_markers(ax):
+    """Draw all MARK and SET times as one vline collection each."""
+    ymin, ymax = ax.get_ylim()
+    if marker_times:
+        ax.vlines(marker_times, ymin, ymax, colors='red', linestyles='--', alpha=0.6, label='MARK')
+    if set_times:
+        ax.vlines(set_times, ymin, ymax, colors='blue', linestyles=':', alpha=0.6, label='SET')
+    ax.set_ylim(ymin, ymax)
+
 plt.figure(figsize=(10, 5))
 plt.plot(t_values, r_values, label="R (uV)", linestyle='-', marker='o', markersize=2)
-for mark_time in marker_times:
-    plt.axvline(x=mark_time, color='red', linestyle='--', alpha=0.6, label='MARK' if mark_time == marker_times[0] else "")
-for set_time in set_times:
-    plt.axvline(x=set_time, color='blue', linestyle=':', alpha=0.6, label='SET' if set_time == set_times[0] else "")
+draw_markers(plt.gca())
 plt.title("R over Time")
 plt.xlabel("Time (s)")
 plt.ylabel("R (uV)")
@@ -117,15 +254,13 @@ plt.grid(True)
 plt.legend()
 plt.tight_layout()
 plt.savefig(plot_r_filename)
-plt.show()
+if interactive:
+    plt.show()
 
 # === Plot Theta vs t ===
 plt.figure(figsize=(10, 5))
 plt.plot(t_values, theta_values, label="Theta (deg)", linestyle='-', marker='x', color='orange', markersize=2)
-for mark_time in marker_times:
-    plt.axvline(x=mark_time, color='red', linestyle='--', alpha=0.6, label='MARK' if mark_time == marker_times[0] else "")
-for set_time in set_times:
-    plt.axvline(x=set_time, color='blue', linestyle=':', alpha=0.6, label='SET' if set_time == set_times[0] else "")
+draw_markers(plt.gca())
 plt.title("Theta over Time")
 plt.xlabel("Time (s)")
 plt.ylabel("Theta (°)")
@@ -137,18 +272,18 @@ plt.savefig(plot_theta_filename)
 
 # === FFT of R ===
 
-r_array = np.array(r_values)
-n = len(r_array)
-r_fft = np.fft.fft(r_array)
-freqs = np.fft.fftfreq(n, d=sampling_interval)
-pos_freqs = freqs[:n // 2]
-magnitude = np.abs(r_fft[:n // 2])
-
-with open(fft_csv_filename, mode='w', newline='') as file:
-    writer = csv.writer(file)
-    writer.writerow(["Frequency (Hz)", "Magnitude"])
-    for f, m in zip(pos_freqs, magnitude):
-        writer.writerow([f, m])
+n = len(r_values)
+if pyfftw is not None:
+    r_array = pyfftw.empty_aligned(n, dtype='float64')
+    r_array[:] = r_values
+    r_fft = pyfftw.interfaces.numpy_fft.rfft(r_array, threads=os.cpu_count())
+else:
+    r_fft = np.fft.rfft(r_values)
+pos_freqs = np.fft.rfftfreq(n, d=sampling_interval)
+magnitude = np.abs(r_fft)
+
+np.savetxt(fft_csv_filename, np.column_stack([pos_freqs, magnitude]), delimiter=',',
+           header="Frequency (Hz),Magnitude", comments='', fmt='%.10g')
 plt.figure(figsize=(10, 5))
 plt.plot(pos_freqs, magnitude, color='purple')
 plt.title("FFT of R")
@@ -1,7 +1,12 @@
 from pymeasure.instruments import Instrument
 import numpy as np
-import csv
+import sys
 import time
+import matplotlib
+
+INTERACTIVE = "--interactive" in sys.argv
+if not INTERACTIVE:
+    matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 
 
@@ -12,17 +17,23 @@ class KeysightE5080B(Instrument):
         super().__init__(resource_name, "Keysight E5080B VNA")
         if hasattr(self.adapter, "connection"):
             self.adapter.connection.timeout = 10000  # 10 s timeout for long sweeps
-        self.write(":FORM:DATA ASCII")  # ensure ASCII data for parsing
+            self.adapter.connection.chunk_size = 1 << 20  # read a full trace in one call
 
     # --- Setup functions ---
     def preset(self):
         """Preset instrument to factory defaults."""
         self.write(":SYST:PRES")
 
-    def set_frequency_range(self, start, stop):
+    def set_start_frequency(self, start):
         self.write(f":SENS1:FREQ:STAR {start}")
+
+    def set_stop_frequency(self, stop):
         self.write(f":SENS1:FREQ:STOP {stop}")
 
+    def set_frequency_range(self, start, stop):
+        self.set_start_frequency(start)
+        self.set_stop_frequency(stop)
+
     def set_points(self, points):
         self.write(f":SENS1:SWE:POIN {points}")
 
@@ -32,10 +43,43 @@ class KeysightE5080B(Instrument):
     def set_if_bandwidth(self, bw):
         self.write(f":SENS1:BWID {bw}")
 
+    # --- Setup functions that skip unchanged settings ---
+    def _ensure(self, query, setter, value):
+        """Call setter(value) only if the instrument's current setting differs."""
+        if float(self.ask(query)) != float(value):
+            setter(value)
+
+    def ensure_frequency_range(self, start, stop):
+        self._ensure(":SENS1:FREQ:STAR?", self.set_start_frequency, start)
+        self._ensure(":SENS1:FREQ:STOP?", self.set_stop_frequency, stop)
+
+    def ensure_points(self, points):
+        self._ensure(":SENS1:SWE:POIN?", self.set_points, points)
+
+    def ensure_power(self, power_dbm):
+        self._ensure(":SOUR1:POW?", self.set_power, power_dbm)
+
+    def ensure_if_bandwidth(self, bw):
+        self._ensure(":SENS1:BWID?", self.set_if_bandwidth, bw)
+
+    def measurements(self):
+        """Return the channel 1 measurements as a {name: parameter} dict."""
+        cat = self.ask(":CALC1:PAR:CAT?").strip().strip('"')
+        items = [item.strip() for item in cat.split(",")] if cat else []
+        return dict(zip(items[::2], (p.upper() for p in items[1::2])))
+
     def select_measurement(self, sparam="S21"):
-        """Select or create an S-parameter measurement (e.g., S21, S11)."""
-        self.write(f":CALC1:PAR:DEF 'Meas1',{sparam}")
-        self.write(":DISP:WIND1:TRAC1:FEED 'Meas1'")
+        """Select or create an S-parameter measurement (e.g., S21, S11).
+
+        'Meas1' is only (re)defined if it is missing or measures a different
+        parameter, so reruns without a preset don't queue SCPI errors.
+        """
+        current = self.measurements().get("Meas1")
+        if current != sparam.upper():
+            if current is not None:
+                self.write(":CALC1:PAR:DEL 'Meas1'")
+            self.write(f":CALC1:PAR:DEF 'Meas1',{sparam}")
+            self.write(":DISP:WIND1:TRAC1:FEED 'Meas1'")
         self.write(":CALC1:PAR:SEL 'Meas1'")
 
     def load_calibration(self, filepath):
@@ -57,7 +101,16 @@ class KeysightE5080B(Instrument):
 
     def fetch_sdata(self):
         """Fetch complex S-parameter data as complex NumPy array."""
-        raw = np.array(self.values(":CALC1:DATA? SDATA"), dtype=float)
+        # Format is set on every fetch since a preset restores ASCII/NORMal order.
+        if hasattr(self.adapter, "connection"):
+            self.write(":FORM:DATA REAL,64")  # binary float64 data transfer
+            self.write(":FORM:BORD SWAP")  # little-endian byte order
+            raw = self.adapter.connection.query_binary_values(
+                ":CALC1:DATA? SDATA", datatype="d", container=np.ndarray
+            )
+        else:
+            self.write(":FORM:DATA ASCII")
+            raw = np.array(self.values(":CALC1:DATA? SDATA"), dtype=float)
         if len(raw) < 2:
             raise RuntimeError("Incomplete data returned from VNA.")
         re, im = raw[::2], raw[1::2]
@@ -88,6 +141,8 @@ IF_BW = 1e3            # Hz
 FIELDS = np.linspace(0.05, 0.30, 6)  # Tesla (dummy field values)
 CAL_FILE = "FMR_calibration.corr"
 OUTPUT_CSV = "FMR_pymeasure_results.csv"
+OUTPUT_PLOT = "FMR_pymeasure_results.png"
+RESET = "--reset" in sys.argv  # preset the VNA before configuring
 
 
 # --- MAIN SCRIPT ---
@@ -99,14 +154,17 @@ try:
     idn = vna.ask("*IDN?")
     print("Connected to:", idn.strip())
 
-    print("\nPresetting and configuring VNA...")
-    vna.preset()
-    time.sleep(5)
-
-    vna.set_frequency_range(START_FREQ, STOP_FREQ)
-    vna.set_points(POINTS)
-    vna.set_power(POWER)
-    vna.set_if_bandwidth(IF_BW)
+    if RESET:
+        print("\nPresetting and configuring VNA...")
+        vna.preset()
+        time.sleep(5)
+    else:
+        print("\nConfiguring VNA (pass --reset to preset first)...")
+
+    vna.ensure_frequency_range(START_FREQ, STOP_FREQ)
+    vna.ensure_points(POINTS)
+    vna.ensure_power(POWER)
+    vna.ensure_if_bandwidth(IF_BW)
     vna.select_measurement("S21")
     vna.set_single_sweep()
 
@@ -120,6 +178,7 @@ try:
     vna.check_errors()
 
     freqs = np.linspace(START_FREQ, STOP_FREQ, POINTS)
+    freqs_ghz = freqs * 1e-9  # plot axis, computed once for all traces
     results = {}
 
     def set_magnet_field(field):
@@ -136,43 +195,46 @@ try:
         print(f"✓ Sweep complete for {field:.3f} T")
 
     print("\nAll sweeps complete.")
+    assert all(len(trace) == len(freqs) for trace in results.values()), "Trace length mismatch!"
+
+    # Stack traces as (points x fields) and convert to dB from |S21|^2 (no sqrt)
+    cplx = np.stack([results[field] for field in FIELDS], axis=1)
+    power = cplx.real * cplx.real + cplx.imag * cplx.imag + 1e-24
+    mag_db_matrix = 10 * np.log10(power)
 
     # ===========================================================
     # --- PLOT RESULTS ---
     # ===========================================================
     plt.figure(figsize=(8, 5))
-    for field, data in results.items():
-        mag_db = 20 * np.log10(np.abs(data) + 1e-12)
-        plt.plot(freqs / 1e9, mag_db, label=f"{field:.2f} T")
+    for i, field in enumerate(FIELDS):
+        plt.plot(freqs_ghz, mag_db_matrix[:, i], label=f"{field:.2f} T")
     plt.xlabel("Frequency (GHz)")
     plt.ylabel("|S21| (dB)")
     plt.title("FMR Sweeps (PyMeasure + Keysight E5080B)")
     plt.legend()
     plt.grid(True, alpha=0.3)
     plt.tight_layout()
-    plt.show()
+    plt.savefig(OUTPUT_PLOT)
+    if INTERACTIVE:
+        plt.show()
 
     # ===========================================================
     # --- SAVE DATA ---
     # ===========================================================
     print(f"\nSaving data to '{OUTPUT_CSV}'...")
-    assert all(len(trace) == len(freqs) for trace in results.values()), "Trace length mismatch!"
-
-    mag_db_matrix = np.column_stack([
-        20 * np.log10(np.abs(results[field]) + 1e-12) for field in FIELDS
-    ])
     data_to_save = np.column_stack([freqs, mag_db_matrix])
 
     header = ["Frequency (Hz)"] + [f"S21_mag_dB_H{field:.3f}T" for field in FIELDS]
-    with open(OUTPUT_CSV, mode="w", newline="") as f:
-        writer = csv.writer(f)
-        writer.writerow(["# Keysight E5080B Sweep Data"])
-        writer.writerow([f"# Freq range: {START_FREQ/1e9:.3f}-{STOP_FREQ/1e9:.3f} GHz"])
-        writer.writerow([f"# Points: {POINTS}, Power: {POWER} dBm, IF BW: {IF_BW} Hz"])
-        writer.writerow([f"# Calibration: {CAL_FILE}"])
-        writer.writerow([])
-        writer.writerow(header)
-        writer.writerows(data_to_save)
+    header_lines = [
+        "# Keysight E5080B Sweep Data",
+        f"# Freq range: {START_FREQ/1e9:.3f}-{STOP_FREQ/1e9:.3f} GHz",
+        f"# Points: {POINTS}, Power: {POWER} dBm, IF BW: {IF_BW} Hz",
+        f"# Calibration: {CAL_FILE}",
+        "",
+        ",".join(header),
+    ]
+    np.savetxt(OUTPUT_CSV, data_to_save, delimiter=",",
+               header="\n".join(header_lines), comments="", fmt="%.10g")
 
     print("✅ Data saved successfully!")
 